@@ -1,16 +1,32 @@
 import logging
 import os
 import json
+import aiofiles
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.context import FSMContext
-from aiogram.filters import Command
+from aiogram.filters import Command, StateFilter
 from aiogram.filters.state import State, StatesGroup
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
 import asyncio
+import contextlib
 import datetime
-from typing import Dict, Any, Optional
+import functools
+import heapq
+import itertools
+import operator
+import secrets
+from collections import Counter, defaultdict, deque
+from dataclasses import dataclass, asdict, fields
+from typing import Dict, Any, List, Optional, Set, Callable, Awaitable, Coroutine
 from dotenv import load_dotenv
+from aiolimiter import AsyncLimiter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Загрузка переменных окружения из .env файла
 load_dotenv()
@@ -33,15 +49,104 @@ if not API_TOKEN:
     raise ValueError("Токен бота не найден. Проверьте файл .env или переменные окружения.")
 
 try:
-    ADMINS = list(map(int, os.getenv('TELEGRAM_ADMINS', '').split(','))) if os.getenv('TELEGRAM_ADMINS') else []
+    ADMINS = frozenset(map(int, os.getenv('TELEGRAM_ADMINS', '').split(','))) if os.getenv('TELEGRAM_ADMINS') else frozenset()
     if not ADMINS:
         logger.warning("Администраторы не указаны. Бот будет работать без админ-панели.")
 except ValueError:
     logger.error("Некорректный формат ID администраторов в TELEGRAM_ADMINS")
-    ADMINS = []
+    ADMINS = frozenset()
 
 DONATE_URL = os.getenv('DONATE_URL', 'https://example.com/donate')
 
+# Пул соединений с Telegram API
+HTTP_POOL_LIMIT = 100
+HTTP_KEEPALIVE_TIMEOUT = 75  # секунд
+
+# Лимиты Telegram: ~30 сообщений в секунду всего и ~20 в минуту в один чат.
+# Держим запас, чтобы не получать RetryAfter
+CHAT_RATE, CHAT_PERIOD = 18, 60
+GLOBAL_LIMITER = AsyncLimiter(28, 1)
+CHAT_LIMITERS: Dict[int, AsyncLimiter] = {}
+chat_limiters_swept_at = 0.0
+
+
+DATA_FILE = 'data.json'
+WAL_FILE = 'data.wal'
+SNAPSHOT_INTERVAL = 10  # секунд между полными снимками
+SNAPSHOT_MAX_ENTRIES = 100  # или после стольких записей в журнале
+WAL_COALESCE_DELAY = 0.5  # секунд на накопление изменений перед записью в журнал
+
+@dataclass(slots=True)
+class Booking:
+    id: str
+    type: str  # 'cottage' или 'table'
+    date: str  # ДД.ММ.ГГГГ
+    guests: int
+    user_id: int
+    user_name: str
+    phone: str
+    status: str  # 'pending', 'confirmed' или 'rejected'
+    created_at: str  # ISO 8601
+
+
+BOOKING_FIELDS = tuple(field.name for field in fields(Booking))
+# Значения всех полей брони одним кортежем: намного дешевле asdict
+booking_values = operator.attrgetter(*BOOKING_FIELDS)
+
+
+# Сериализация JSON: orjson, если установлен, иначе стандартный json
+def dumps_json(obj: Any, indent: bool = False) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False).encode('utf-8')
+
+
+def loads_json(raw: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+# Очередь изменений для фоновой записи
+save_queue: asyncio.Queue = asyncio.Queue()
+
+
+# Применение одной записи журнала к данным
+def apply_delta(data: Dict[str, Any], delta: Dict[str, Any]):
+    op = delta['op']
+    if op == 'put_booking':
+        data['bookings'][delta['id']] = delta['data']
+    elif op == 'put_review':
+        data['reviews'][delta['id']] = delta['data']
+    elif op == 'put_tables':
+        data['tables'].update(delta['data'])
+    elif op == 'batch':
+        # Несколько изменений одной строкой: применяются все вместе или ни одно
+        for sub_delta in delta['ops']:
+            apply_delta(data, sub_delta)
+    else:
+        logger.warning("Неизвестная операция в журнале: %s", op)
+
+
+# Воспроизведение журнала изменений поверх снимка
+def replay_wal(data: Dict[str, Any]) -> int:
+    if not os.path.exists(WAL_FILE):
+        return 0
+
+    applied = 0
+    with open(WAL_FILE, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                apply_delta(data, loads_json(line))
+            except (json.JSONDecodeError, KeyError) as e:
+                # Оборванная последняя строка после аварийного завершения
+                logger.warning("Пропущена поврежденная запись журнала: %s", e)
+                continue
+            applied += 1
+    return applied
+
 
 # Загрузка данных из файла
 def load_data() -> Dict[str, Any]:
@@ -52,13 +157,12 @@ def load_data() -> Dict[str, Any]:
     }
 
     try:
-        if not os.path.exists('data.json'):
+        if not os.path.exists(DATA_FILE):
             logger.warning("Файл данных не найден, создается новый")
-            save_data(default_data)
-            return default_data
-
-        with open('data.json', 'r', encoding='utf-8') as f:
-            data = json.load(f)
+            data = default_data
+        else:
+            with open(DATA_FILE, 'rb') as f:
+                data = loads_json(f.read())
 
             # Проверяем структуру данных
             if not all(key in data for key in ['bookings', 'tables', 'reviews']):
@@ -66,36 +170,212 @@ def load_data() -> Dict[str, Any]:
                 for key in default_data:
                     if key not in data:
                         data[key] = default_data[key]
-                save_data(data)
 
-            return data
+        applied = replay_wal(data)
+        if applied:
+            logger.info("Восстановлено %s записей из журнала изменений", applied)
+
+        # Сворачиваем журнал в свежий снимок
+        write_snapshot(data)
+        return data
 
     except json.JSONDecodeError:
-        logger.error("Ошибка чтения JSON, создаем новый файл данных")
-        save_data(default_data)
+        # Поврежденный снимок не затираем, а откладываем для ручного разбора. Журнал остается
+        # на месте: его изменения применяются к пустым данным и попадут в следующий снимок
+        corrupt_file = f"{DATA_FILE}.corrupt-{datetime.datetime.now():%Y%m%d%H%M%S}"
+        logger.error("Ошибка чтения JSON, поврежденный файл сохранен как %s", corrupt_file)
+        try:
+            os.replace(DATA_FILE, corrupt_file)
+        except OSError as e:
+            logger.error("Не удалось сохранить поврежденный файл данных: %s", e)
+        applied = replay_wal(default_data)
+        if applied:
+            logger.info("Восстановлено %s записей из журнала изменений", applied)
         return default_data
     except Exception as e:
-        logger.error(f"Критическая ошибка загрузки данных: {e}, используем данные по умолчанию")
+        logger.error("Критическая ошибка загрузки данных: %s, используем данные по умолчанию", e)
         return default_data
 
 
-# Сохранение данных в файл
-def save_data(data: Dict[str, Any]):
+# Атомарная запись полного снимка и очистка журнала
+def write_snapshot(data: Dict[str, Any]):
     try:
-        with open('data.json', 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        tmp_file = DATA_FILE + '.tmp'
+        payload = dumps_json(data, indent=True)
+        # Буфер под весь снимок: файл записывается одним системным вызовом
+        with open(tmp_file, 'wb', buffering=len(payload)) as f:
+            f.write(payload)
+            f.flush()
+            # Данные должны быть на диске до замены, иначе после сбоя питания можно получить пустой файл
+            os.fsync(f.fileno())
+        os.replace(tmp_file, DATA_FILE)
+        if os.path.exists(WAL_FILE):
+            os.remove(WAL_FILE)
     except Exception as e:
-        logger.error(f"Ошибка сохранения данных: {e}")
+        logger.error("Ошибка сохранения данных: %s", e)
+
+
+# Сохранение изменения: запись попадает в журнал фоновой задачей
+async def save_data(delta: Dict[str, Any]):
+    await save_queue.put(delta)
+
+
+async def persist(deltas: List[Dict[str, Any]], snapshot: bool):
+    """Дописывает изменения в журнал и при необходимости сохраняет полный снимок"""
+    if deltas:
+        async with aiofiles.open(WAL_FILE, 'ab') as wal:
+            await wal.write(b''.join(dumps_json(delta) + b'\n' for delta in deltas))
+    if snapshot:
+        await asyncio.to_thread(write_state_snapshot, get_snapshot())
+
+
+async def writer_task():
+    """Пишет изменения в журнал и периодически сохраняет полный снимок"""
+    loop = asyncio.get_running_loop()
+    last_snapshot = loop.time()
+    pending = 0
+
+    while True:
+        deltas = []
+        try:
+            deltas.append(await asyncio.wait_for(save_queue.get(), timeout=SNAPSHOT_INTERVAL))
+            # Даем накопиться соседним изменениям, чтобы записать их одним вызовом
+            await asyncio.sleep(WAL_COALESCE_DELAY)
+            while not save_queue.empty():
+                deltas.append(save_queue.get_nowait())
+        except asyncio.TimeoutError:
+            pass
+
+        pending += len(deltas)
+        snapshot_due = bool(pending) and (pending >= SNAPSHOT_MAX_ENTRIES
+                                          or loop.time() - last_snapshot >= SNAPSHOT_INTERVAL)
+        if not deltas and not snapshot_due:
+            continue
+
+        # Начатую запись доводим до конца даже при отмене задачи: иначе поток с журналом
+        # или снимком продолжит писать параллельно с итоговым снимком в main()
+        io_task = asyncio.ensure_future(persist(deltas, snapshot_due))
+        try:
+            await asyncio.shield(io_task)
+        except asyncio.CancelledError:
+            await asyncio.wait({io_task})
+            raise
+        except Exception as e:
+            logger.error("Ошибка записи журнала изменений: %s", e)
+            continue
+
+        if snapshot_due:
+            last_snapshot = loop.time()
+            pending = 0
 
 
 # Инициализация данных
 data = load_data()
-bookings_db = data['bookings']
+bookings_db: Dict[str, Booking] = {bid: Booking(**b) for bid, b in data['bookings'].items()}
 tables_db = data['tables']
 reviews_db = data['reviews']
 
+
+def get_snapshot() -> Dict[str, Any]:
+    # Копии словарей: снимок сериализуется в отдельном потоке, пока обработчики продолжают работу.
+    # Вызывается в цикле событий, поэтому брони копируются кортежами значений, а словари
+    # собирает write_state_snapshot уже в потоке
+    return {
+        'bookings': {bid: booking_values(b) for bid, b in bookings_db.items()},
+        'tables': dict(tables_db),
+        'reviews': dict(reviews_db)
+    }
+
+
+def write_state_snapshot(snapshot: Dict[str, Any]):
+    snapshot['bookings'] = {bid: dict(zip(BOOKING_FIELDS, values))
+                            for bid, values in snapshot['bookings'].items()}
+    write_snapshot(snapshot)
+
+
+# Защищает проверку и изменение статусов бронирований и счетчика столиков от гонок
+tables_lock = asyncio.Lock()
+
+
+def get_booking(booking_id: str) -> Optional[Booking]:
+    """Единая точка чтения бронирования по ID"""
+    return bookings_db.get(booking_id)
+
+
+def booking_status_delta(booking: Booking) -> Dict[str, Any]:
+    """Запись журнала о смене статуса; для столика вместе со счетчиком столиков"""
+    delta = {'op': 'put_booking', 'id': booking.id, 'data': asdict(booking)}
+    if booking.type == 'table':
+        return {'op': 'batch', 'ops': [delta, {'op': 'put_tables', 'data': dict(tables_db)}]}
+    return delta
+
+
+# Индексы бронирований, чтобы не перебирать bookings_db в обработчиках
+user_index: Dict[int, Set[str]] = {}
+cottage_date_index: Dict[str, Set[str]] = {}  # дата -> подтвержденные брони коттеджа
+confirmed_users: Set[int] = set()
+
+# Счетчики для статистики, обновляются при каждом изменении
+status_counts: Counter = Counter()
+review_stats = {'count': 0, 'sum': 0}
+
+# ID бронирований по статусам, новые (созданные или перешедшие в статус) — в начале
+by_status: Dict[str, deque] = defaultdict(deque)
+
+
+def index_booking(booking: Booking):
+    user_index.setdefault(booking.user_id, set()).add(booking.id)
+    if booking.status == 'confirmed':
+        confirmed_users.add(booking.user_id)
+        if booking.type == 'cottage':
+            cottage_date_index.setdefault(booking.date, set()).add(booking.id)
+
+
+def set_booking_status(booking: Booking, status: str):
+    """Меняет статус бронирования и поддерживает индексы в актуальном состоянии"""
+    was_confirmed = booking.status == 'confirmed'
+    status_counts[booking.status] -= 1
+    status_counts[status] += 1
+    by_status[booking.status].remove(booking.id)
+    by_status[status].appendleft(booking.id)
+    booking.status = status
+
+    if status == 'confirmed':
+        index_booking(booking)
+    elif was_confirmed:
+        if booking.type == 'cottage':
+            booked = cottage_date_index.get(booking.date, set())
+            booked.discard(booking.id)
+            if not booked:
+                cottage_date_index.pop(booking.date, None)
+
+        user_id = booking.user_id
+        if not any(bookings_db[bid].status == 'confirmed' for bid in user_index.get(user_id, ())):
+            confirmed_users.discard(user_id)
+
+
+def build_indexes():
+    for booking in sorted(bookings_db.values(), key=lambda x: x.created_at):
+        index_booking(booking)
+        status_counts[booking.status] += 1
+        by_status[booking.status].appendleft(booking.id)
+
+    review_stats['count'] = len(reviews_db)
+    review_stats['sum'] = sum(r['rating'] for r in reviews_db.values())
+
+
+build_indexes()
+
+
 # Инициализация бота
-bot = Bot(token=API_TOKEN)
+session = AiohttpSession(limit=HTTP_POOL_LIMIT)
+# Все запросы идут на один хост, поэтому лимит на хост равен общему;
+# соединения держим открытыми, чтобы не устанавливать TLS заново на каждый запрос
+session._connector_init.update(
+    limit_per_host=HTTP_POOL_LIMIT,
+    keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+)
+bot = Bot(token=API_TOKEN, session=session)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 
@@ -114,52 +394,71 @@ class BookingStates(StatesGroup):
     waiting_for_review_text = State()
 
 
-# Клавиатуры
-def get_main_menu():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="🏠 Забронировать коттедж")],
-            [KeyboardButton(text="🍾 Забронировать столик")],
-            [KeyboardButton(text="💸 Оставить чаевые")],
-            [KeyboardButton(text="⭐️ Оставить отзыв")]
-        ],
-        resize_keyboard=True
-    )
-    return keyboard
-
-
-def get_admin_menu():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="📊 Статистика")],
-            [KeyboardButton(text="📋 Список бронирований")],
-            [KeyboardButton(text="❌ Отменить бронирование")],
-            [KeyboardButton(text="✏️ Изменить кол-во столиков")],
-            [KeyboardButton(text="🔙 В главное меню")]
-        ],
-        resize_keyboard=True
-    )
-    return keyboard
+# Подписи статусов и типов бронирования
+STATUS_MAP = {
+    'pending': '⏳ Ожидает подтверждения',
+    'confirmed': '✅ Подтверждено',
+    'rejected': '❌ Отклонено'
+}
+TYPE_LABEL = {'cottage': 'Коттедж', 'table': 'Столик'}
+
+
+# Клавиатуры (неизменяемые, создаются один раз)
+MAIN_MENU = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="🏠 Забронировать коттедж")],
+        [KeyboardButton(text="🍾 Забронировать столик")],
+        [KeyboardButton(text="💸 Оставить чаевые")],
+        [KeyboardButton(text="⭐️ Оставить отзыв")]
+    ],
+    resize_keyboard=True
+)
 
+ADMIN_MENU = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="📊 Статистика")],
+        [KeyboardButton(text="📋 Список бронирований")],
+        [KeyboardButton(text="❌ Отменить бронирование")],
+        [KeyboardButton(text="✏️ Изменить кол-во столиков")],
+        [KeyboardButton(text="🔙 В главное меню")]
+    ],
+    resize_keyboard=True
+)
 
-def get_cancel_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="🔙 Отменить")]],
-        resize_keyboard=True
-    )
-    return keyboard
+CANCEL_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="🔙 Отменить")]],
+    resize_keyboard=True
+)
+
+REVIEW_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="⭐️ 1"), KeyboardButton(text="⭐️ 2")],
+        [KeyboardButton(text="⭐️ 3"), KeyboardButton(text="⭐️ 4")],
+        [KeyboardButton(text="⭐️ 5"), KeyboardButton(text="🔙 Отменить")]
+    ],
+    resize_keyboard=True
+)
 
+CONTACT_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="📱 Отправить контакт", request_contact=True)],
+        [KeyboardButton(text="📞 Ввести номер вручную")],
+        [KeyboardButton(text="🔙 Отменить")]
+    ],
+    resize_keyboard=True
+)
 
-def get_review_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="⭐️ 1"), KeyboardButton(text="⭐️ 2")],
-            [KeyboardButton(text="⭐️ 3"), KeyboardButton(text="⭐️ 4")],
-            [KeyboardButton(text="⭐️ 5"), KeyboardButton(text="🔙 Отменить")]
-        ],
-        resize_keyboard=True
-    )
-    return keyboard
+DONATE_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="💖 Перейти к оплате", url=DONATE_URL)]
+])
+
+
+def get_booking_actions_keyboard(booking_id: str) -> InlineKeyboardMarkup:
+    """Кнопки подтверждения/отклонения заявки для администратора"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"confirm_{booking_id}")],
+        [InlineKeyboardButton(text="❌ Отклонить", callback_data=f"reject_{booking_id}")]
+    ])
 
 
 # Middleware для проверки администратора
@@ -174,32 +473,185 @@ async def admin_check_middleware(handler, event, data):
 dp.callback_query.middleware(admin_check_middleware)
 
 
+# Middleware очередности: aiogram обрабатывает обновления параллельными задачами,
+# а здесь обновления одного чата выстраиваются по порядку. Разные чаты не ждут друг друга
+chat_locks: Dict[int, asyncio.Lock] = {}
+chat_lock_users: Counter = Counter()
+
+
+async def chat_order_middleware(handler, event, data):
+    chat = data.get('event_chat')
+    if chat is None:
+        return await handler(event, data)
+
+    chat_id = chat.id
+    lock = chat_locks.setdefault(chat_id, asyncio.Lock())
+    chat_lock_users[chat_id] += 1
+    try:
+        async with lock:
+            return await handler(event, data)
+    finally:
+        # Замок чата удаляем, когда его больше никто не ждет
+        chat_lock_users[chat_id] -= 1
+        if not chat_lock_users[chat_id]:
+            del chat_lock_users[chat_id]
+            del chat_locks[chat_id]
+
+
+dp.update.outer_middleware(chat_order_middleware)
+
+
 # Вспомогательные функции
+def generate_id(existing: Dict[str, Any]) -> str:
+    """Случайный 8-символьный ID, не занятый в коллекции"""
+    while True:
+        new_id = secrets.token_hex(4)
+        if new_id not in existing:
+            return new_id
+
+
+def parse_date(text: str) -> datetime.date:
+    """Разбирает дату в формате ДД.ММ.ГГГГ (быстрее, чем datetime.strptime)"""
+    day, month, year = text.split('.')
+    if not (len(day) <= 2 and len(month) <= 2 and len(year) == 4
+            and day.isdigit() and month.isdigit() and year.isdigit()):
+        raise ValueError(f"Некорректная дата: {text}")
+    return datetime.date(int(year), int(month), int(day))
+
+
+_fromisoformat = datetime.datetime.fromisoformat
+
+
+@functools.lru_cache(maxsize=1024)
+def format_created_at(created_at: str) -> str:
+    """Время создания брони для карточки; created_at не меняется, поэтому кэшируем"""
+    return _fromisoformat(created_at).strftime('%d.%m.%Y %H:%M')
+
+
 def is_date_available(booking_type: str, date: str) -> bool:
     """Проверяет доступность даты для бронирования"""
     if booking_type == 'table':
         return tables_db['available'] > 0
 
     # Для коттеджей можно добавить проверку на конкретные даты
-    booked_dates = [b['date'] for b in bookings_db.values()
-                   if b['type'] == 'cottage' and b['status'] == 'confirmed']
-    return date not in booked_dates
+    return not cottage_date_index.get(date)
+
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора до завершения
+background_tasks: Set[asyncio.Task] = set()
+BACKGROUND_TASKS_TIMEOUT = 10  # секунд на завершение фоновых отправок при остановке
+
+
+def run_in_background(coro: Coroutine[Any, Any, Any]):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+def get_chat_limiter(chat_id: int) -> AsyncLimiter:
+    global chat_limiters_swept_at
+    limiter = CHAT_LIMITERS.get(chat_id)
+    if limiter is None:
+        # Не чаще раза за период удаляем опустевшие корзины, чтобы словарь не рос с каждым новым чатом.
+        # Полная емкость значит, что с последней отправки прошел целый период и состояние не нужно
+        now = asyncio.get_running_loop().time()
+        if now - chat_limiters_swept_at >= CHAT_PERIOD:
+            chat_limiters_swept_at = now
+            for idle_chat_id in [cid for cid, lim in CHAT_LIMITERS.items() if lim.has_capacity(CHAT_RATE)]:
+                del CHAT_LIMITERS[idle_chat_id]
+        limiter = CHAT_LIMITERS[chat_id] = AsyncLimiter(CHAT_RATE, CHAT_PERIOD)
+    return limiter
+
+
+async def send_limited(chat_id: int, text: str, **kwargs):
+    """Отправляет сообщение с соблюдением лимитов Telegram"""
+    # Сначала ждем лимит чата, чтобы не занимать глобальный лимит во время ожидания
+    async with get_chat_limiter(chat_id), GLOBAL_LIMITER:
+        return await bot.send_message(chat_id, text, **kwargs)
+
+
+async def run_together(*requests: Awaitable[Any]):
+    """Выполняет независимые запросы к Telegram одновременно"""
+    # Методы aiogram (SendMessage, AnswerCallbackQuery) — нехешируемые pydantic-модели,
+    # а asyncio.gather кладет аргументы в словарь, поэтому сначала оборачиваем их в задачи
+    await asyncio.gather(*(asyncio.ensure_future(request) for request in requests))
 
 
 async def notify_admins(message: str, booking_id: Optional[str] = None):
     """Отправляет уведомление всем администраторам"""
-    for admin_id in ADMINS:
+    keyboard = get_booking_actions_keyboard(booking_id) if booking_id else None
+    # Рассылаем параллельно: задержка равна самой медленной отправке, а не их сумме
+    results = await asyncio.gather(
+        *(send_limited(admin_id, message, reply_markup=keyboard) for admin_id in ADMINS),
+        return_exceptions=True
+    )
+    for admin_id, result in zip(ADMINS, results):
+        if isinstance(result, Exception):
+            logger.error("Ошибка отправки уведомления администратору %s: %s", admin_id, result)
+
+
+def safe_handler(handler):
+    """Логирует исключения обработчика, сбрасывает состояние FSM и отвечает на callback"""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(event, *args, **kwargs):
         try:
-            keyboard = None
-            if booking_id:
-                keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"confirm_{booking_id}")],
-                    [InlineKeyboardButton(text="❌ Отклонить", callback_data=f"reject_{booking_id}")]
-                ])
-
-            await bot.send_message(admin_id, message, reply_markup=keyboard)
-        except Exception as e:
-            logger.error(f"Ошибка отправки уведомления администратору {admin_id}: {e}")
+            return await handler(event, *args, **kwargs)
+        except Exception:
+            logger.exception("Ошибка в %s", name)
+            state = kwargs.get('state') or next((a for a in args if isinstance(a, FSMContext)), None)
+            if state is not None:
+                await state.clear()
+            if isinstance(event, types.CallbackQuery):
+                await event.answer("⚠️ Произошла ошибка")
+
+    return wrapper
+
+
+# Кнопки меню: текст кнопки -> обработчик.
+# Один фильтр со словарем вместо отдельного F.text == "..." на каждую кнопку
+MenuHandler = Callable[[types.Message, FSMContext], Awaitable[Any]]
+TEXT_DISPATCH: Dict[str, MenuHandler] = {}
+
+
+def menu_button(text: str):
+    """Регистрирует обработчик кнопки меню"""
+    def decorator(handler: MenuHandler) -> MenuHandler:
+        TEXT_DISPATCH[text] = handler
+        return handler
+    return decorator
+
+
+# Зарегистрирован раньше обработчиков состояний и без StateFilter: кнопка меню срабатывает
+# в любом состоянии FSM. Раньше часть кнопок перехватывали шаги диалога (например,
+# «Забронировать столик» на шаге даты коттеджа давала ошибку формата даты)
+@dp.message(F.text.in_(TEXT_DISPATCH))
+async def menu_dispatch(message: types.Message, state: FSMContext):
+    await TEXT_DISPATCH[message.text](message, state)
+
+
+# Отмена в любом шаге бронирования или отзыва — один обработчик вместо проверки в каждом
+CANCEL_TOKENS = frozenset({"🔙 Отменить"})
+REVIEW_STATES = (BookingStates.waiting_for_review_rating, BookingStates.waiting_for_review_text)
+REVIEW_STATE_NAMES = frozenset(s.state for s in REVIEW_STATES)
+
+
+@dp.message(F.text.in_(CANCEL_TOKENS), StateFilter(
+    BookingStates.waiting_for_cottage_date,
+    BookingStates.waiting_for_cottage_guests,
+    BookingStates.waiting_for_table_date,
+    BookingStates.waiting_for_table_guests,
+    BookingStates.waiting_for_contact,
+    *REVIEW_STATES
+))
+async def cancel_handler(message: types.Message, state: FSMContext):
+    current_state = await state.get_state()
+    await state.clear()
+    if current_state in REVIEW_STATE_NAMES:
+        await message.answer("❌ Отзыв не сохранен.", reply_markup=MAIN_MENU)
+    else:
+        await message.answer("❌ Бронирование отменено.", reply_markup=MAIN_MENU)
 
 
 # Обработчики команд
@@ -207,229 +659,157 @@ async def notify_admins(message: str, booking_id: Optional[str] = None):
 async def cmd_start(message: types.Message):
     try:
         if message.from_user.id in ADMINS:
-            await message.answer("👋 Добро пожаловать в админ-панель ClubOK!", reply_markup=get_admin_menu())
+            await message.answer("👋 Добро пожаловать в админ-панель ClubOK!", reply_markup=ADMIN_MENU)
         else:
-            await message.answer("🎉 Добро пожаловать в ClubOK!", reply_markup=get_main_menu())
+            await message.answer("🎉 Добро пожаловать в ClubOK!", reply_markup=MAIN_MENU)
     except Exception as e:
-        logger.error(f"Ошибка в cmd_start: {e}")
+        logger.error("Ошибка в cmd_start: %s", e)
         await message.answer("⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.")
 
 
-@dp.message(F.text == "💸 Оставить чаевые")
-async def donate_handler(message: types.Message):
-    try:
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="💖 Перейти к оплате", url=DONATE_URL)]
-        ])
-        await message.answer("💌 Благодарим за вашу щедрость!", reply_markup=keyboard)
-    except Exception as e:
-        logger.error(f"Ошибка в donate_handler: {e}")
+@menu_button("💸 Оставить чаевые")
+@safe_handler
+async def donate_handler(message: types.Message, state: FSMContext):
+    await message.answer("💌 Благодарим за вашу щедрость!", reply_markup=DONATE_KEYBOARD)
 
 
 # Бронирование коттеджа
-@dp.message(F.text == "🏠 Забронировать коттедж")
+@menu_button("🏠 Забронировать коттедж")
+@safe_handler
 async def book_cottage_start(message: types.Message, state: FSMContext):
-    try:
-        await state.set_state(BookingStates.waiting_for_cottage_date)
-        await message.answer("📅 На какую дату вы хотите забронировать коттедж? (ДД.ММ.ГГГГ)",
-                           reply_markup=get_cancel_keyboard())
-    except Exception as e:
-        logger.error(f"Ошибка в book_cottage_start: {e}")
-        await state.clear()
+    await state.set_state(BookingStates.waiting_for_cottage_date)
+    await message.answer("📅 На какую дату вы хотите забронировать коттедж? (ДД.ММ.ГГГГ)",
+                       reply_markup=CANCEL_KEYBOARD)
 
 
 @dp.message(BookingStates.waiting_for_cottage_date)
+@safe_handler
 async def process_cottage_date(message: types.Message, state: FSMContext):
     try:
-        if message.text == "🔙 Отменить":
-            await state.clear()
-            await message.answer("❌ Бронирование отменено.", reply_markup=get_main_menu())
-            return
-
-        try:
-            booking_date = datetime.datetime.strptime(message.text, "%d.%m.%Y").date()
-        except ValueError:
-            await message.answer("❌ Неверный формат даты. Пожалуйста, введите дату в формате ДД.ММ.ГГГГ:")
-            return
+        booking_date = parse_date(message.text)
+    except ValueError:
+        await message.answer("❌ Неверный формат даты. Пожалуйста, введите дату в формате ДД.ММ.ГГГГ:")
+        return
 
-        today = datetime.date.today()
+    today = datetime.date.today()
 
-        if booking_date < today:
-            await message.answer("❌ Нельзя забронировать коттедж на прошедшую дату. Введите корректную дату:")
-            return
+    if booking_date < today:
+        await message.answer("❌ Нельзя забронировать коттедж на прошедшую дату. Введите корректную дату:")
+        return
 
-        if (booking_date - today).days > 365:
-            await message.answer("❌ Бронирование возможно только на даты в течение года. Введите другую дату:")
-            return
+    if (booking_date - today).days > 365:
+        await message.answer("❌ Бронирование возможно только на даты в течение года. Введите другую дату:")
+        return
 
-        if not is_date_available('cottage', message.text):
-            await message.answer("❌ К сожалению, коттедж на эту дату уже забронирован. Выберите другую дату:")
-            return
+    if not is_date_available('cottage', message.text):
+        await message.answer("❌ К сожалению, коттедж на эту дату уже забронирован. Выберите другую дату:")
+        return
 
-        await state.update_data(booking_date=message.text)
-        await state.set_state(BookingStates.waiting_for_cottage_guests)
-        await message.answer("👥 Укажите количество гостей:", reply_markup=get_cancel_keyboard())
-    except Exception as e:
-        logger.error(f"Ошибка в process_cottage_date: {e}")
-        await state.clear()
+    await state.update_data(booking_date=message.text)
+    await state.set_state(BookingStates.waiting_for_cottage_guests)
+    await message.answer("👥 Укажите количество гостей:", reply_markup=CANCEL_KEYBOARD)
 
 
 @dp.message(BookingStates.waiting_for_cottage_guests)
+@safe_handler
 async def process_cottage_guests(message: types.Message, state: FSMContext):
-    try:
-        if message.text == "🔙 Отменить":
-            await state.clear()
-            await message.answer("❌ Бронирование отменено.", reply_markup=get_main_menu())
-            return
-
-        if not message.text.isdigit():
-            await message.answer("❌ Пожалуйста, введите число:", reply_markup=get_cancel_keyboard())
-            return
-
-        guests = int(message.text)
-        if guests < 1 or guests > 20:
-            await message.answer("❌ Количество гостей должно быть от 1 до 20. Введите корректное число:",
-                               reply_markup=get_cancel_keyboard())
-            return
+    if not message.text.isdigit():
+        await message.answer("❌ Пожалуйста, введите число:", reply_markup=CANCEL_KEYBOARD)
+        return
 
-        await state.update_data(guests=guests, booking_type="cottage")
-        await state.set_state(BookingStates.waiting_for_contact)
+    guests = int(message.text)
+    if guests < 1 or guests > 20:
+        await message.answer("❌ Количество гостей должно быть от 1 до 20. Введите корректное число:",
+                           reply_markup=CANCEL_KEYBOARD)
+        return
 
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="📱 Отправить контакт", request_contact=True)],
-                [KeyboardButton(text="📞 Ввести номер вручную")],
-                [KeyboardButton(text="🔙 Отменить")]
-            ],
-            resize_keyboard=True
-        )
+    await state.update_data(guests=guests, booking_type="cottage")
+    await state.set_state(BookingStates.waiting_for_contact)
 
-        await message.answer("📞 Пожалуйста, поделитесь вашим контактом для подтверждения бронирования:",
-                           reply_markup=keyboard)
-    except Exception as e:
-        logger.error(f"Ошибка в process_cottage_guests: {e}")
-        await state.clear()
+    await message.answer("📞 Пожалуйста, поделитесь вашим контактом для подтверждения бронирования:",
+                       reply_markup=CONTACT_KEYBOARD)
 
 
 # Бронирование столика
-@dp.message(F.text == "🍾 Забронировать столик")
+@menu_button("🍾 Забронировать столик")
+@safe_handler
 async def book_table_start(message: types.Message, state: FSMContext):
-    try:
-        if tables_db['available'] <= 0:
-            await message.answer("😔 К сожалению, сейчас нет свободных столиков.")
-            return
+    if tables_db['available'] <= 0:
+        await message.answer("😔 К сожалению, сейчас нет свободных столиков.")
+        return
 
-        await state.set_state(BookingStates.waiting_for_table_date)
-        await message.answer("📅 На какую дату вы хотите забронировать столик? (ДД.ММ.ГГГГ)",
-                           reply_markup=get_cancel_keyboard())
-    except Exception as e:
-        logger.error(f"Ошибка в book_table_start: {e}")
-        await state.clear()
+    await state.set_state(BookingStates.waiting_for_table_date)
+    await message.answer("📅 На какую дату вы хотите забронировать столик? (ДД.ММ.ГГГГ)",
+                       reply_markup=CANCEL_KEYBOARD)
 
 
 @dp.message(BookingStates.waiting_for_table_date)
+@safe_handler
 async def process_table_date(message: types.Message, state: FSMContext):
     try:
-        if message.text == "🔙 Отменить":
-            await state.clear()
-            await message.answer("❌ Бронирование отменено.", reply_markup=get_main_menu())
-            return
-
-        try:
-            booking_date = datetime.datetime.strptime(message.text, "%d.%m.%Y").date()
-        except ValueError:
-            await message.answer("❌ Неверный формат даты. Пожалуйста, введите дату в формате ДД.ММ.ГГГГ:")
-            return
+        booking_date = parse_date(message.text)
+    except ValueError:
+        await message.answer("❌ Неверный формат даты. Пожалуйста, введите дату в формате ДД.ММ.ГГГГ:")
+        return
 
-        today = datetime.date.today()
+    today = datetime.date.today()
 
-        if booking_date < today:
-            await message.answer("❌ Нельзя забронировать столик на прошедшую дату. Введите корректную дату:")
-            return
+    if booking_date < today:
+        await message.answer("❌ Нельзя забронировать столик на прошедшую дату. Введите корректную дату:")
+        return
 
-        if (booking_date - today).days > 365:
-            await message.answer("❌ Бронирование возможно только на даты в течение года. Введите другую дату:")
-            return
+    if (booking_date - today).days > 365:
+        await message.answer("❌ Бронирование возможно только на даты в течение года. Введите другую дату:")
+        return
 
-        await state.update_data(booking_date=message.text)
-        await state.set_state(BookingStates.waiting_for_table_guests)
-        await message.answer("👥 Укажите количество гостей:", reply_markup=get_cancel_keyboard())
-    except Exception as e:
-        logger.error(f"Ошибка в process_table_date: {e}")
-        await state.clear()
+    await state.update_data(booking_date=message.text)
+    await state.set_state(BookingStates.waiting_for_table_guests)
+    await message.answer("👥 Укажите количество гостей:", reply_markup=CANCEL_KEYBOARD)
 
 
 @dp.message(BookingStates.waiting_for_table_guests)
+@safe_handler
 async def process_table_guests(message: types.Message, state: FSMContext):
-    try:
-        if message.text == "🔙 Отменить":
-            await state.clear()
-            await message.answer("❌ Бронирование отменено.", reply_markup=get_main_menu())
-            return
-
-        if not message.text.isdigit():
-            await message.answer("❌ Пожалуйста, введите число:", reply_markup=get_cancel_keyboard())
-            return
+    if not message.text.isdigit():
+        await message.answer("❌ Пожалуйста, введите число:", reply_markup=CANCEL_KEYBOARD)
+        return
 
-        guests = int(message.text)
-        if guests < 1 or guests > 10:
-            await message.answer("❌ Количество гостей за 1 стол должно быть от 1 до 10. Введите корректное число:",
-                               reply_markup=get_cancel_keyboard())
-            return
+    guests = int(message.text)
+    if guests < 1 or guests > 10:
+        await message.answer("❌ Количество гостей за 1 стол должно быть от 1 до 10. Введите корректное число:",
+                           reply_markup=CANCEL_KEYBOARD)
+        return
 
-        await state.update_data(guests=guests, booking_type="table")
-        await state.set_state(BookingStates.waiting_for_contact)
+    await state.update_data(guests=guests, booking_type="table")
+    await state.set_state(BookingStates.waiting_for_contact)
 
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="📱 Отправить контакт", request_contact=True)],
-                [KeyboardButton(text="📞 Ввести номер вручную")],
-                [KeyboardButton(text="🔙 Отменить")]
-            ],
-            resize_keyboard=True
-        )
-
-        await message.answer("📞 Пожалуйста, поделитесь вашим контактом для подтверждения бронирования:",
-                           reply_markup=keyboard)
-    except Exception as e:
-        logger.error(f"Ошибка в process_table_guests: {e}")
-        await state.clear()
+    await message.answer("📞 Пожалуйста, поделитесь вашим контактом для подтверждения бронирования:",
+                       reply_markup=CONTACT_KEYBOARD)
 
 
 # Обработка контакта
 @dp.message(BookingStates.waiting_for_contact, F.contact)
+@safe_handler
 async def process_contact(message: types.Message, state: FSMContext):
-    try:
-        contact = message.contact
-        await _save_booking(message, state, contact.phone_number)
-    except Exception as e:
-        logger.error(f"Ошибка в process_contact: {e}")
-        await state.clear()
+    contact = message.contact
+    await _save_booking(message, state, contact.phone_number)
 
 
 @dp.message(BookingStates.waiting_for_contact)
+@safe_handler
 async def process_contact_manual(message: types.Message, state: FSMContext):
-    try:
-        if message.text == "🔙 Отменить":
-            await state.clear()
-            await message.answer("❌ Бронирование отменено.", reply_markup=get_main_menu())
-            return
-
-        if message.text == "📞 Ввести номер вручную":
-            await message.answer("📱 Введите ваш номер телефона в формате +79991234567:",
-                               reply_markup=get_cancel_keyboard())
-            return
+    if message.text == "📞 Ввести номер вручную":
+        await message.answer("📱 Введите ваш номер телефона в формате +79991234567:",
+                           reply_markup=CANCEL_KEYBOARD)
+        return
 
-        # Валидация номера телефона
-        phone = ''.join(filter(str.isdigit, message.text))
-        if len(phone) < 11:
-            await message.answer("❌ Неверный формат телефона. Пожалуйста, введите номер в формате +79991234567:")
-            return
+    # Валидация номера телефона
+    phone = ''.join(filter(str.isdigit, message.text))
+    if len(phone) < 11:
+        await message.answer("❌ Неверный формат телефона. Пожалуйста, введите номер в формате +79991234567:")
+        return
 
-        await _save_booking(message, state, phone)
-    except Exception as e:
-        logger.error(f"Ошибка в process_contact_manual: {e}")
-        await state.clear()
+    await _save_booking(message, state, phone)
 
 
 async def _save_booking(message: types.Message, state: FSMContext, phone: str):
@@ -437,428 +817,423 @@ async def _save_booking(message: types.Message, state: FSMContext, phone: str):
     user_data = await state.get_data()
 
     # Проверка на дублирование бронирования
-    existing_booking = next((b for b in bookings_db.values()
-                           if b['user_id'] == message.from_user.id
-                           and b['date'] == user_data['booking_date']
-                           and b['type'] == user_data['booking_type']
-                           and b['status'] == 'pending'), None)
-    if existing_booking:
+    has_pending_booking = any(
+        bookings_db[bid].status == 'pending'
+        and bookings_db[bid].date == user_data['booking_date']
+        and bookings_db[bid].type == user_data['booking_type']
+        for bid in user_index.get(message.from_user.id, ())
+    )
+    if has_pending_booking:
         await message.answer("⚠️ У вас уже есть ожидающее бронирование на эту дату.")
         await state.clear()
         return
 
-    booking_id = str(datetime.datetime.now().timestamp()).replace('.', '')[-8:]
-    booking_details = {
-        'id': booking_id,
-        'type': user_data['booking_type'],
-        'date': user_data['booking_date'],
-        'guests': user_data['guests'],
-        'user_id': message.from_user.id,
-        'user_name': message.from_user.full_name,
-        'phone': phone,
-        'status': 'pending',
-        'created_at': datetime.datetime.now().isoformat()
-    }
+    booking_id = generate_id(bookings_db)
+    booking_details = Booking(
+        id=booking_id,
+        type=user_data['booking_type'],
+        date=user_data['booking_date'],
+        guests=user_data['guests'],
+        user_id=message.from_user.id,
+        user_name=message.from_user.full_name,
+        phone=phone,
+        status='pending',
+        created_at=datetime.datetime.now().isoformat()
+    )
 
     bookings_db[booking_id] = booking_details
-    save_data({'bookings': bookings_db, 'tables': tables_db, 'reviews': reviews_db})
+    index_booking(booking_details)
+    status_counts['pending'] += 1
+    by_status['pending'].appendleft(booking_id)
+    await save_data({'op': 'put_booking', 'id': booking_id, 'data': asdict(booking_details)})
+
+    await state.clear()
+    await send_limited(message.chat.id, "✅ Ваша заявка принята! Ожидайте подтверждения от администратора.",
+                       reply_markup=MAIN_MENU)
 
-    # Уведомление администраторов
-    await notify_admins(
+    # Уведомление администраторов в фоне: лимит чата администратора не должен задерживать клиента
+    run_in_background(notify_admins(
         f"📌 Новая заявка на бронирование:\n\n"
-        f"🔹 Тип: {'Коттедж' if booking_details['type'] == 'cottage' else 'Столик'}\n"
-        f"🔹 Дата: {booking_details['date']}\n"
-        f"🔹 Гостей: {booking_details['guests']}\n"
-        f"🔹 Клиент: {booking_details['user_name']}\n"
-        f"🔹 Телефон: {booking_details['phone']}\n\n"
+        f"🔹 Тип: {TYPE_LABEL[booking_details.type]}\n"
+        f"🔹 Дата: {booking_details.date}\n"
+        f"🔹 Гостей: {booking_details.guests}\n"
+        f"🔹 Клиент: {booking_details.user_name}\n"
+        f"🔹 Телефон: {booking_details.phone}\n\n"
         f"ID брони: {booking_id}",
         booking_id
-    )
-
-    await state.clear()
-    await message.answer("✅ Ваша заявка принята! Ожидайте подтверждения от администратора.",
-                       reply_markup=get_main_menu())
+    ))
 
 
 # Система отзывов
-@dp.message(F.text == "⭐️ Оставить отзыв")
+@menu_button("⭐️ Оставить отзыв")
+@safe_handler
 async def start_review(message: types.Message, state: FSMContext):
-    try:
-        # Проверяем, есть ли у пользователя подтвержденные бронирования
-        has_confirmed_bookings = any(
-            b['user_id'] == message.from_user.id and b['status'] == 'confirmed'
-            for b in bookings_db.values()
-        )
+    # Проверяем, есть ли у пользователя подтвержденные бронирования
+    if message.from_user.id not in confirmed_users:
+        await message.answer("❌ Вы можете оставить отзыв только после посещения нашего заведения.")
+        return
 
-        if not has_confirmed_bookings:
-            await message.answer("❌ Вы можете оставить отзыв только после посещения нашего заведения.")
-            return
+    await state.set_state(BookingStates.waiting_for_review_rating)
+    await message.answer("Оцените ваш визит от 1 до 5 звезд:", reply_markup=REVIEW_KEYBOARD)
 
-        await state.set_state(BookingStates.waiting_for_review_rating)
-        await message.answer("Оцените ваш визит от 1 до 5 звезд:", reply_markup=get_review_keyboard())
-    except Exception as e:
-        logger.error(f"Ошибка в start_review: {e}")
-        await state.clear()
+
+RATING_BUTTONS = {f"⭐️ {i}": i for i in range(1, 6)}
 
 
-@dp.message(BookingStates.waiting_for_review_rating, F.text.regexp(r'⭐️ [1-5]'))
+@dp.message(BookingStates.waiting_for_review_rating, F.text.in_(RATING_BUTTONS))
+@safe_handler
 async def process_review_rating(message: types.Message, state: FSMContext):
-    try:
-        rating = int(message.text.split()[1])
-        await state.update_data(rating=rating)
-        await state.set_state(BookingStates.waiting_for_review_text)
-        await message.answer("Напишите ваш отзыв (или нажмите 'Пропустить'):",
-                           reply_markup=get_cancel_keyboard())
-    except Exception as e:
-        logger.error(f"Ошибка в process_review_rating: {e}")
-        await state.clear()
+    rating = RATING_BUTTONS[message.text]
+    await state.update_data(rating=rating)
+    await state.set_state(BookingStates.waiting_for_review_text)
+    await message.answer("Напишите ваш отзыв (или нажмите 'Пропустить'):",
+                       reply_markup=CANCEL_KEYBOARD)
 
 
 @dp.message(BookingStates.waiting_for_review_text)
+@safe_handler
 async def process_review_text(message: types.Message, state: FSMContext):
-    try:
-        if message.text == "🔙 Отменить":
-            await state.clear()
-            await message.answer("❌ Отзыв не сохранен.", reply_markup=get_main_menu())
-            return
-
-        user_data = await state.get_data()
-        review_id = str(datetime.datetime.now().timestamp()).replace('.', '')[-8:]
+    user_data = await state.get_data()
+    review_id = generate_id(reviews_db)
 
-        reviews_db[review_id] = {
-            'user_id': message.from_user.id,
-            'user_name': message.from_user.full_name,
-            'rating': user_data['rating'],
-            'text': message.text if message.text != "Пропустить" else "",
-            'date': datetime.datetime.now().isoformat()
-        }
+    reviews_db[review_id] = {
+        'user_id': message.from_user.id,
+        'user_name': message.from_user.full_name,
+        'rating': user_data['rating'],
+        'text': message.text if message.text != "Пропустить" else "",
+        'date': datetime.datetime.now().isoformat()
+    }
+    review_stats['count'] += 1
+    review_stats['sum'] += user_data['rating']
 
-        save_data({'bookings': bookings_db, 'tables': tables_db, 'reviews': reviews_db})
+    await save_data({'op': 'put_review', 'id': review_id, 'data': dict(reviews_db[review_id])})
 
-        await state.clear()
-        await message.answer("Спасибо за ваш отзыв!", reply_markup=get_main_menu())
+    await state.clear()
+    await message.answer("Спасибо за ваш отзыв!", reply_markup=MAIN_MENU)
 
-        # Уведомление администраторов о новом отзыве
-        review_text = f"⭐️ Новый отзыв!\n\nОценка: {user_data['rating']}/5"
-        if reviews_db[review_id]['text']:
-            review_text += f"\nОтзыв: {reviews_db[review_id]['text']}"
+    # Уведомление администраторов о новом отзыве
+    review_text = f"⭐️ Новый отзыв!\n\nОценка: {user_data['rating']}/5"
+    if reviews_db[review_id]['text']:
+        review_text += f"\nОтзыв: {reviews_db[review_id]['text']}"
 
-        await notify_admins(review_text)
-    except Exception as e:
-        logger.error(f"Ошибка в process_review_text: {e}")
-        await state.clear()
+    run_in_background(notify_admins(review_text))
 
 
 # Админ-команды
-@dp.message(F.text == "📊 Статистика")
-async def show_stats(message: types.Message):
-    try:
-        if message.from_user.id not in ADMINS:
-            return
+@menu_button("📊 Статистика")
+@safe_handler
+async def show_stats(message: types.Message, state: FSMContext):
+    if message.from_user.id not in ADMINS:
+        return
 
-        pending = sum(1 for b in bookings_db.values() if b['status'] == 'pending')
-        confirmed = sum(1 for b in bookings_db.values() if b['status'] == 'confirmed')
-        rejected = sum(1 for b in bookings_db.values() if b['status'] == 'rejected')
+    pending = status_counts['pending']
+    confirmed = status_counts['confirmed']
+    rejected = status_counts['rejected']
+
+    # Статистика отзывов
+    reviews_count = review_stats['count']
+    avg_rating = review_stats['sum'] / reviews_count if reviews_count else 0
+
+    await message.answer(
+        f"📊 Статистика:\n\n"
+        f"📌 Бронирования:\n"
+        f"⏳ Ожидают: {pending}\n"
+        f"✅ Подтверждены: {confirmed}\n"
+        f"❌ Отклонены: {rejected}\n\n"
+        f"🍾 Столики:\n"
+        f"Доступно: {tables_db['available']}/{tables_db['total']}\n\n"
+        f"⭐️ Отзывы:\n"
+        f"Средний рейтинг: {avg_rating:.1f}/5\n"
+        f"Всего отзывов: {reviews_count}"
+    )
 
-        # Статистика отзывов
-        if reviews_db:
-            avg_rating = sum(r['rating'] for r in reviews_db.values()) / len(reviews_db)
-            reviews_count = len(reviews_db)
-        else:
-            avg_rating = 0
-            reviews_count = 0
-
-        await message.answer(
-            f"📊 Статистика:\n\n"
-            f"📌 Бронирования:\n"
-            f"⏳ Ожидают: {pending}\n"
-            f"✅ Подтверждены: {confirmed}\n"
-            f"❌ Отклонены: {rejected}\n\n"
-            f"🍾 Столики:\n"
-            f"Доступно: {tables_db['available']}/{tables_db['total']}\n\n"
-            f"⭐️ Отзывы:\n"
-            f"Средний рейтинг: {avg_rating:.1f}/5\n"
-            f"Всего отзывов: {reviews_count}"
-        )
-    except Exception as e:
-        logger.error(f"Ошибка в show_stats: {e}")
 
+@menu_button("📋 Список бронирований")
+@safe_handler
+async def list_bookings(message: types.Message, state: FSMContext):
+    if message.from_user.id not in ADMINS:
+        return
 
-@dp.message(F.text == "📋 Список бронирований")
-async def list_bookings(message: types.Message):
-    try:
-        if message.from_user.id not in ADMINS:
-            return
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[])
+    for booking in heapq.nlargest(10, bookings_db.values(), key=lambda x: x.created_at):
+        status_icon = "🟡" if booking.status == 'pending' else "🟢" if booking.status == 'confirmed' else "🔴"
+        btn_text = f"{status_icon} {TYPE_LABEL[booking.type]} на {booking.date}"
+        keyboard.inline_keyboard.append(
+            [InlineKeyboardButton(text=btn_text, callback_data=f"info_{booking.id}")]
+        )
 
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[])
-        for booking in sorted(bookings_db.values(),
-                            key=lambda x: x['created_at'],
-                            reverse=True)[:10]:
-            status_icon = "🟡" if booking['status'] == 'pending' else "🟢" if booking['status'] == 'confirmed' else "🔴"
-            btn_text = f"{status_icon} {'Коттедж' if booking['type'] == 'cottage' else 'Столик'} на {booking['date']}"
-            keyboard.inline_keyboard.append(
-                [InlineKeyboardButton(text=btn_text, callback_data=f"info_{booking['id']}")]
-            )
-
-        await message.answer("📋 Последние бронирования:", reply_markup=keyboard)
-    except Exception as e:
-        logger.error(f"Ошибка в list_bookings: {e}")
+    await message.answer("📋 Последние бронирования:", reply_markup=keyboard)
 
 
-@dp.message(F.text == "❌ Отменить бронирование")
-async def cancel_booking_start(message: types.Message):
-    try:
-        if message.from_user.id not in ADMINS:
-            return
+@menu_button("❌ Отменить бронирование")
+@safe_handler
+async def cancel_booking_start(message: types.Message, state: FSMContext):
+    if message.from_user.id not in ADMINS:
+        return
 
-        active_bookings = [b for b in bookings_db.values() if b['status'] == 'confirmed']
-        if not active_bookings:
-            await message.answer("❌ Нет активных бронирований для отмены.")
-            return
+    if not by_status['confirmed']:
+        await message.answer("❌ Нет активных бронирований для отмены.")
+        return
 
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[])
-        for booking in sorted(active_bookings,
-                            key=lambda x: x['created_at'],
-                            reverse=True)[:10]:
-            btn_text = f"{'Коттедж' if booking['type'] == 'cottage' else 'Столик'} на {booking['date']} ({booking['guests']} чел.)"
-            keyboard.inline_keyboard.append(
-                [InlineKeyboardButton(text=btn_text, callback_data=f"cancel_{booking['id']}")]
-            )
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[])
+    for booking_id in itertools.islice(by_status['confirmed'], 10):
+        booking = bookings_db[booking_id]
+        btn_text = f"{TYPE_LABEL[booking.type]} на {booking.date} ({booking.guests} чел.)"
+        keyboard.inline_keyboard.append(
+            [InlineKeyboardButton(text=btn_text, callback_data=f"cancel_{booking.id}")]
+        )
 
-        await message.answer("📋 Выберите бронирование для отмены:", reply_markup=keyboard)
-    except Exception as e:
-        logger.error(f"Ошибка в cancel_booking_start: {e}")
+    await message.answer("📋 Выберите бронирование для отмены:", reply_markup=keyboard)
 
 
-@dp.message(F.text == "✏️ Изменить кол-во столиков")
+@menu_button("✏️ Изменить кол-во столиков")
+@safe_handler
 async def change_tables_start(message: types.Message, state: FSMContext):
-    try:
-        if message.from_user.id not in ADMINS:
-            return
+    if message.from_user.id not in ADMINS:
+        return
 
-        await state.set_state(BookingStates.waiting_for_tables_count)
-        await message.answer(f"✏️ Текущее количество столиков: {tables_db['total']}\n"
-                           f"Доступно: {tables_db['available']}\n\n"
-                           f"Введите новое общее количество столиков:")
-    except Exception as e:
-        logger.error(f"Ошибка в change_tables_start: {e}")
-        await state.clear()
+    await state.set_state(BookingStates.waiting_for_tables_count)
+    await message.answer(f"✏️ Текущее количество столиков: {tables_db['total']}\n"
+                       f"Доступно: {tables_db['available']}\n\n"
+                       f"Введите новое общее количество столиков:")
 
 
 @dp.message(BookingStates.waiting_for_tables_count)
+@safe_handler
 async def process_tables_count(message: types.Message, state: FSMContext):
-    try:
-        if not message.text.isdigit():
-            await message.answer("❌ Пожалуйста, введите число:")
-            return
+    if not message.text.isdigit():
+        await message.answer("❌ Пожалуйста, введите число:")
+        return
 
-        new_count = int(message.text)
-        if new_count < 1:
-            await message.answer("❌ Количество столиков должно быть положительным числом. Введите корректное значение:")
-            return
+    new_count = int(message.text)
+    if new_count < 1:
+        await message.answer("❌ Количество столиков должно быть положительным числом. Введите корректное значение:")
+        return
 
+    async with tables_lock:
         # Проверяем, что новое количество не меньше уже забронированных столиков
         booked_tables = tables_db['total'] - tables_db['available']
-        if new_count < booked_tables:
-            await message.answer(f"❌ Нельзя установить меньше {booked_tables} столиков (уже забронировано).")
-            return
+        if new_count >= booked_tables:
+            tables_db['total'] = new_count
+            tables_db['available'] = new_count - booked_tables
+            await save_data({'op': 'put_tables', 'data': dict(tables_db)})
 
-        old_count = tables_db['total']
-        tables_db['total'] = new_count
-        tables_db['available'] = new_count - booked_tables
-        save_data({'bookings': bookings_db, 'tables': tables_db, 'reviews': reviews_db})
+    if new_count < booked_tables:
+        await message.answer(f"❌ Нельзя установить меньше {booked_tables} столиков (уже забронировано).")
+        return
 
-        await state.clear()
-        await message.answer(
-            f"✅ Количество столиков изменено. Теперь доступно {tables_db['available']}/{tables_db['total']}",
-            reply_markup=get_admin_menu())
-    except Exception as e:
-        logger.error(f"Ошибка в process_tables_count: {e}")
-        await state.clear()
+    await state.clear()
+    await message.answer(
+        f"✅ Количество столиков изменено. Теперь доступно {tables_db['available']}/{tables_db['total']}",
+        reply_markup=ADMIN_MENU)
 
 
 # Callback-обработчики
 @dp.callback_query(F.data.startswith('confirm_'))
+@safe_handler
 async def process_confirm(callback: types.CallbackQuery):
-    try:
-        booking_id = callback.data.split('_')[1]
-        booking = bookings_db.get(booking_id)
+    _, _, booking_id = callback.data.partition('_')
+    booking = get_booking(booking_id)
 
-        if not booking:
-            await callback.answer("❌ Бронирование не найдено!")
-            return
-
-        if booking['status'] != 'pending':
-            await callback.answer("ℹ️ Это бронирование уже обработано!")
-            return
+    if not booking:
+        await callback.answer("❌ Бронирование не найдено!")
+        return
 
-        if booking['type'] == 'table' and tables_db['available'] <= 0:
-            await callback.answer("❌ Нет свободных столиков!")
-            return
+    # Под замком только проверка и изменение данных, ответы отправляем после
+    async with tables_lock:
+        if booking.status != 'pending':
+            error = "ℹ️ Это бронирование уже обработано!"
+        elif booking.type == 'table' and tables_db['available'] <= 0:
+            error = "❌ Нет свободных столиков!"
+        else:
+            error = None
+            set_booking_status(booking, 'confirmed')
+            if booking.type == 'table':
+                tables_db['available'] -= 1
+            await save_data(booking_status_delta(booking))
+
+    if error:
+        await callback.answer(error)
+        return
 
-        booking['status'] = 'confirmed'
-        if booking['type'] == 'table':
-            tables_db['available'] -= 1
-        save_data({'bookings': bookings_db, 'tables': tables_db, 'reviews': reviews_db})
+    await callback.message.edit_text(
+        f"✅ Бронирование {booking_id} подтверждено!\n\n" + callback.message.text.split('\n\n')[1]
+    )
 
-        await callback.message.edit_text(
-            f"✅ Бронирование {booking_id} подтверждено!\n\n" + callback.message.text.split('\n\n')[1]
+    try:
+        await send_limited(
+            booking.user_id,
+            f"🎉 Ваше бронирование подтверждено!\n\n"
+            f"🔹 Тип: {TYPE_LABEL[booking.type]}\n"
+            f"🔹 Дата: {booking.date}\n"
+            f"🔹 Гостей: {booking.guests}\n\n"
+            f"Ждем вас в ClubOK!"
         )
-
-        try:
-            await bot.send_message(
-                booking['user_id'],
-                f"🎉 Ваше бронирование подтверждено!\n\n"
-                f"🔹 Тип: {'Коттедж' if booking['type'] == 'cottage' else 'Столик'}\n"
-                f"🔹 Дата: {booking['date']}\n"
-                f"🔹 Гостей: {booking['guests']}\n\n"
-                f"Ждем вас в ClubOK!"
-            )
-        except Exception as e:
-            logger.error(f"Ошибка отправки подтверждения пользователю {booking['user_id']}: {e}")
-
-        await callback.answer()
     except Exception as e:
-        logger.error(f"Ошибка в process_confirm: {e}")
-        await callback.answer("⚠️ Произошла ошибка")
+        logger.error("Ошибка отправки подтверждения пользователю %s: %s", booking.user_id, e)
+
+    await callback.answer()
 
 
 @dp.callback_query(F.data.startswith('reject_'))
+@safe_handler
 async def process_reject(callback: types.CallbackQuery, state: FSMContext):
-    try:
-        booking_id = callback.data.split('_')[1]
-        booking = bookings_db.get(booking_id)
+    _, _, booking_id = callback.data.partition('_')
+    booking = get_booking(booking_id)
 
-        if not booking:
-            await callback.answer("❌ Бронирование не найдено!")
-            return
+    if not booking:
+        await callback.answer("❌ Бронирование не найдено!")
+        return
 
-        if booking['status'] != 'pending':
-            await callback.answer("ℹ️ Это бронирование уже обработано!")
-            return
+    # Как и в process_confirm: под замком только проверка и смена статуса
+    async with tables_lock:
+        already_processed = booking.status != 'pending'
+        if not already_processed:
+            set_booking_status(booking, 'rejected')
+            await save_data({'op': 'put_booking', 'id': booking_id, 'data': asdict(booking)})
 
-        booking['status'] = 'rejected'
-        save_data({'bookings': bookings_db, 'tables': tables_db, 'reviews': reviews_db})
+    if already_processed:
+        await callback.answer("ℹ️ Это бронирование уже обработано!")
+        return
 
-        await callback.message.edit_text(
-            f"❌ Бронирование {booking_id} отклонено!\n\n" + callback.message.text.split('\n\n')[1]
-        )
+    await callback.message.edit_text(
+        f"❌ Бронирование {booking_id} отклонено!\n\n" + callback.message.text.split('\n\n')[1]
+    )
 
-        await state.set_state(BookingStates.waiting_for_admin_comment)
-        await state.update_data(booking_id=booking_id)
+    await state.set_state(BookingStates.waiting_for_admin_comment)
+    await state.update_data(booking_id=booking_id, action='reject')
 
-        await callback.message.answer("📝 Укажите причину отказа (это сообщение увидит клиент):")
-        await callback.answer()
-    except Exception as e:
-        logger.error(f"Ошибка в process_reject: {e}")
-        await callback.answer("⚠️ Произошла ошибка")
+    await run_together(
+        callback.message.answer("📝 Укажите причину отказа (это сообщение увидит клиент):"),
+        callback.answer()
+    )
 
 
 @dp.callback_query(F.data.startswith('cancel_'))
+@safe_handler
 async def process_cancel(callback: types.CallbackQuery, state: FSMContext):
-    try:
-        booking_id = callback.data.split('_')[1]
-        booking = bookings_db.get(booking_id)
+    _, _, booking_id = callback.data.partition('_')
+    booking = get_booking(booking_id)
 
-        if not booking:
-            await callback.answer("❌ Бронирование не найдено!")
-            return
+    if not booking:
+        await callback.answer("❌ Бронирование не найдено!")
+        return
 
-        if booking['status'] != 'confirmed':
-            await callback.answer("ℹ️ Это бронирование уже отменено или не подтверждено!")
-            return
+    if booking.status != 'confirmed':
+        await callback.answer("ℹ️ Это бронирование уже отменено или не подтверждено!")
+        return
 
-        await state.set_state(BookingStates.waiting_for_admin_comment)
-        await state.update_data(booking_id=booking_id)
-        await callback.message.answer("📝 Укажите причину отмены (это сообщение увидит клиент):")
-        await callback.answer()
-    except Exception as e:
-        logger.error(f"Ошибка в process_cancel: {e}")
-        await callback.answer("⚠️ Произошла ошибка")
+    await state.set_state(BookingStates.waiting_for_admin_comment)
+    await state.update_data(booking_id=booking_id, action='cancel')
+    await run_together(
+        callback.message.answer("📝 Укажите причину отмены (это сообщение увидит клиент):"),
+        callback.answer()
+    )
 
 
 @dp.callback_query(F.data.startswith('info_'))
+@safe_handler
 async def show_booking_info(callback: types.CallbackQuery):
-    try:
-        booking_id = callback.data.split('_')[1]
-        booking = bookings_db.get(booking_id)
+    _, _, booking_id = callback.data.partition('_')
+    booking = get_booking(booking_id)
+
+    if not booking:
+        await callback.answer("❌ Бронирование не найдено!")
+        return
+
+    status = booking.status
+    info_text = (
+        f"📋 Информация о бронировании:\n\n"
+        f"🔹 ID: {booking.id}\n"
+        f"🔹 Тип: {TYPE_LABEL[booking.type]}\n"
+        f"🔹 Дата: {booking.date}\n"
+        f"🔹 Гостей: {booking.guests}\n"
+        f"🔹 Клиент: {booking.user_name}\n"
+        f"🔹 Телефон: {booking.phone}\n"
+        f"🔹 Статус: {STATUS_MAP.get(status, status)}\n"
+        f"🔹 Создано: {format_created_at(booking.created_at)}"
+    )
+    # Карточка и ответ на callback — независимые запросы, отправляем одновременно
+    await run_together(callback.message.answer(info_text), callback.answer())
 
-        if not booking:
-            await callback.answer("❌ Бронирование не найдено!")
-            return
 
-        status_map = {
-            'pending': '⏳ Ожидает подтверждения',
-            'confirmed': '✅ Подтверждено',
-            'rejected': '❌ Отклонено'
-        }
-
-        await callback.message.answer(
-            f"📋 Информация о бронировании:\n\n"
-            f"🔹 ID: {booking['id']}\n"
-            f"🔹 Тип: {'Коттедж' if booking['type'] == 'cottage' else 'Столик'}\n"
-            f"🔹 Дата: {booking['date']}\n"
-            f"🔹 Гостей: {booking['guests']}\n"
-            f"🔹 Клиент: {booking['user_name']}\n"
-            f"🔹 Телефон: {booking['phone']}\n"
-            f"🔹 Статус: {status_map.get(booking['status'], booking['status'])}\n"
-            f"🔹 Создано: {datetime.datetime.fromisoformat(booking['created_at']).strftime('%d.%m.%Y %H:%M')}"
+async def notify_user_rejected(booking: Booking, reason: str):
+    try:
+        await send_limited(
+            booking.user_id,
+            f"😔 К сожалению, ваше бронирование отклонено.\n\n"
+            f"🔹 Тип: {TYPE_LABEL[booking.type]}\n"
+            f"🔹 Дата: {booking.date}\n"
+            f"🔹 Гостей: {booking.guests}\n\n"
+            f"Причина: {reason}\n\n"
+            f"Вы можете создать новое бронирование."
         )
-        await callback.answer()
     except Exception as e:
-        logger.error(f"Ошибка в show_booking_info: {e}")
-        await callback.answer("⚠️ Произошла ошибка")
+        logger.error("Ошибка отправки уведомления об отказе пользователю %s: %s", booking.user_id, e)
 
 
 @dp.message(BookingStates.waiting_for_admin_comment)
+@safe_handler
 async def process_admin_comment(message: types.Message, state: FSMContext):
-    try:
-        user_data = await state.get_data()
-        booking_id = user_data['booking_id']
-        booking = bookings_db.get(booking_id)
-
-        if booking:
-            if booking['status'] != 'rejected':
-                if booking['type'] == 'table':
+    user_data = await state.get_data()
+    booking_id = user_data['booking_id']
+    booking = get_booking(booking_id)
+    reason = message.text
+
+    if booking:
+        async with tables_lock:
+            # После «Отклонить» бронь уже отклонена и ждет только причины. При отмене
+            # подтвержденной брони статус rejected значит, что ее успел отменить другой администратор
+            already_rejected = booking.status == 'rejected' and user_data.get('action') == 'cancel'
+            if booking.status != 'rejected':
+                if booking.type == 'table':
                     tables_db['available'] += 1
-                booking['status'] = 'rejected'
-                save_data({'bookings': bookings_db, 'tables': tables_db, 'reviews': reviews_db})
+                set_booking_status(booking, 'rejected')
+                await save_data(booking_status_delta(booking))
 
-            try:
-                await bot.send_message(
-                    booking['user_id'],
-                    f"😔 К сожалению, ваше бронирование отклонено.\n\n"
-                    f"🔹 Тип: {'Коттедж' if booking['type'] == 'cottage' else 'Столик'}\n"
-                    f"🔹 Дата: {booking['date']}\n"
-                    f"🔹 Гостей: {booking['guests']}\n\n"
-                    f"Причина: {message.text}\n\n"
-                    f"Вы можете создать новое бронирование."
-                )
-            except Exception as e:
-                logger.error(f"Ошибка отправки уведомления об отказе пользователю {booking['user_id']}: {e}")
-
-            await message.answer(
-                f"✅ Клиент уведомлен об отмене бронирования.\n"
-                f"ID: {booking_id}\n"
-                f"Причина: {message.text}",
-                reply_markup=get_admin_menu()
-            )
-        else:
-            await message.answer("❌ Бронирование не найдено!", reply_markup=get_admin_menu())
+        if already_rejected:
+            # Клиента уже уведомили, повторное сообщение не отправляем
+            await message.answer("ℹ️ Это бронирование уже отклонено.", reply_markup=ADMIN_MENU)
+            await state.clear()
+            return
 
-        await state.clear()
-    except Exception as e:
-        logger.error(f"Ошибка в process_admin_comment: {e}")
-        await state.clear()
+        # Не заставляем администратора ждать доставки сообщения клиенту
+        run_in_background(notify_user_rejected(booking, reason))
+
+        await message.answer(
+            f"✅ Бронирование отменено, клиенту отправляется уведомление.\n"
+            f"ID: {booking_id}\n"
+            f"Причина: {reason}",
+            reply_markup=ADMIN_MENU
+        )
+    else:
+        await message.answer("❌ Бронирование не найдено!", reply_markup=ADMIN_MENU)
+
+    await state.clear()
 
 # Запуск бота
 async def main():
+    writer = asyncio.create_task(writer_task())
     try:
         logger.info("Starting bot...")
-        await dp.start_polling(bot)
+        # handle_as_tasks: каждое обновление — отдельная задача, порядок внутри чата держит chat_order_middleware
+        await dp.start_polling(bot, handle_as_tasks=True)
     except Exception as e:
-        logger.error(f"Bot crashed: {e}")
+        logger.error("Bot crashed: %s", e)
     finally:
+        writer.cancel()
+        # Дожидаемся writer вместе с начатой записью на диск, чтобы она не пересеклась с итоговым снимком
+        with contextlib.suppress(asyncio.CancelledError):
+            await writer
+        # Итоговый снимок включает все изменения, в том числе не попавшие в журнал
+        write_state_snapshot(get_snapshot())
+        # Доотправляем фоновые уведомления (например, причины отказа) до закрытия сессии
+        if background_tasks:
+            _, unfinished = await asyncio.wait(set(background_tasks), timeout=BACKGROUND_TASKS_TIMEOUT)
+            if unfinished:
+                logger.warning("Не отправлено фоновых уведомлений: %s", len(unfinished))
+                for task in unfinished:
+                    task.cancel()
         await bot.session.close()
         logger.info("Bot stopped")
 